@@ -11,6 +11,10 @@
 #include <vector>
 #include <deque>
 
+#if defined(DBW_USE_NLOHMANN_JSON)
+#include <nlohmann/json_fwd.hpp>
+#endif
+
 namespace dbw {
 
 using SteadyClock = std::chrono::steady_clock;
@@ -111,16 +115,25 @@ private:
 	bool conditionsSatisfied(const Rule &rule, const SignalProvider &signals) const;
 	bool evaluate(const Condition &c, const SignalProvider &signals) const;
 	static bool compare(const Value &lhs, CompareOp op, const Value &rhs);
+	static bool compareBool(bool lhs, CompareOp op, bool rhs);
+	static bool compareNumber(double lhs, CompareOp op, double rhs);
+	static bool compareString(const std::string &lhs, CompareOp op, const std::string &rhs);
 	static std::optional<double> asNumber(const Value &v);
 	static std::optional<std::string> asString(const Value &v);
 	static std::optional<bool> asBool(const Value &v);
 
+#if defined(DBW_USE_NLOHMANN_JSON)
+	bool loadRulesFromJson(const nlohmann::json &j, std::string &errorMessage);
+#endif
+
 	void advanceStep(SteadyClock::time_point now);
+	void enqueueEvent(std::string eventName);
 
 	std::vector<Rule> rules_;
 	std::optional<ActiveSequence> active_;
 	std::deque<std::string> eventQueue_;
-	std::unordered_map<std::string, Value> state_;
+	std::unordered_map<std::string, std::vector<size_t>> rulesByTrigger_; // indices into rules_, in order
+	std::unordered_map<std::string, Value> state_; // keyed as "state.<key>" to match Condition::signal
 };
 
 } // namespace dbw
\ No newline at end of file
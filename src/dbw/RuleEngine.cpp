@@ -3,10 +3,9 @@
 #include "dbw/RuleEngine.hpp"
 
 #include <cmath>
-#include <fstream>
-#include <sstream>
 
 #if defined(DBW_USE_NLOHMANN_JSON)
+#include <fstream>
 #include <nlohmann/json.hpp>
 #endif
 
@@ -16,12 +15,14 @@ void RuleEngine::setRules(std::vector<Rule> rules) {
 	rules_ = std::move(rules);
 	active_.reset();
 	eventQueue_.clear();
-	if (state_.find("auto_mode") == state_.end()) state_["auto_mode"] = false;
+	rulesByTrigger_.clear();
+	for (size_t i = 0; i < rules_.size(); ++i) rulesByTrigger_[rules_[i].trigger].push_back(i);
+	if (state_.find("state.auto_mode") == state_.end()) state_["state.auto_mode"] = false;
 }
 
 void RuleEngine::onEvent(std::string_view eventName) {
 	spdlog::debug("onEvent: {}", eventName);
-	eventQueue_.emplace_back(eventName);
+	enqueueEvent(std::string(eventName));
 }
 
 void RuleEngine::tick(const SignalProvider &signals, CommandBuffer &out) {
@@ -30,32 +31,39 @@ void RuleEngine::tick(const SignalProvider &signals, CommandBuffer &out) {
 
 void RuleEngine::tickAt(const SignalProvider &signals, CommandBuffer &out, SteadyClock::time_point now) {
 	if (!active_.has_value() && !eventQueue_.empty()) {
-		const std::string event = eventQueue_.front();
+		const std::string event = std::move(eventQueue_.front());
 		spdlog::trace("dequeue event: {}", event);
 		eventQueue_.pop_front();
-		for (const Rule &r : rules_) {
-			if (r.trigger == event && conditionsSatisfied(r, signals)) {
-				active_ = ActiveSequence{ &r, 0, now, now };
-				break;
+		auto it = rulesByTrigger_.find(event);
+		if (it != rulesByTrigger_.end()) {
+			for (size_t i : it->second) {
+				const Rule &r = rules_[i];
+				if (conditionsSatisfied(r, signals)) {
+					active_ = ActiveSequence{ &r, 0, now, now };
+					break;
+				}
 			}
 		}
 	}
 
 	if (!active_.has_value()) return;
 
-	if (!conditionsSatisfied(*active_->rule, signals)) {
-		spdlog::warn("rule '{}' cancelled: conditions failed", active_->rule->name);
+	const Rule &rule = *active_->rule;
+	const size_t stepIndex = active_->stepIndex;
+
+	if (!conditionsSatisfied(rule, signals)) {
+		spdlog::warn("rule '{}' cancelled: conditions failed", rule.name);
 		active_.reset();
 		return;
 	}
 
-	if (active_->stepIndex >= active_->rule->sequence.size()) {
+	if (stepIndex >= rule.sequence.size()) {
 		active_.reset();
 		return;
 	}
 
-	const Step &step = active_->rule->sequence[active_->stepIndex];
-	spdlog::trace("rule '{}' step {}", active_->rule->name, active_->stepIndex);
+	const Step &step = rule.sequence[stepIndex];
+	spdlog::trace("rule '{}' step {}", rule.name, stepIndex);
 
 	if (std::holds_alternative<StepSet>(step)) {
 		const StepSet &s = std::get<StepSet>(step);
@@ -76,14 +84,14 @@ void RuleEngine::tickAt(const SignalProvider &signals, CommandBuffer &out, Stead
 
 	if (std::holds_alternative<StepSetState>(step)) {
 		const StepSetState &s = std::get<StepSetState>(step);
-		state_[s.key] = s.value;
+		state_["state." + s.key] = s.value;
 		advanceStep(now);
 		return;
 	}
 
 	if (std::holds_alternative<StepEmitEvent>(step)) {
 		const StepEmitEvent &e = std::get<StepEmitEvent>(step);
-		eventQueue_.push_back(e.name);
+		enqueueEvent(e.name);
 		advanceStep(now);
 		return;
 	}
@@ -115,20 +123,21 @@ bool RuleEngine::conditionsSatisfied(const Rule &rule, const SignalProvider &sig
 
 bool RuleEngine::evaluate(const Condition &c, const SignalProvider &signals) const {
 	if (c.signal.rfind("state.", 0) == 0) {
-		const std::string key = c.signal.substr(6);
-		auto it = state_.find(key);
+		auto it = state_.find(c.signal);
 		if (it == state_.end()) return false;
 		return compare(it->second, c.op, c.value);
 	}
 
-	double n{}; bool b{}; std::string s;
-	if (signals.getNumber(c.signal, n) && std::holds_alternative<double>(c.value))
-		return compare(n, c.op, std::get<double>(c.value));
-	if (signals.getBool(c.signal, b) && std::holds_alternative<bool>(c.value))
-		return compare(b, c.op, std::get<bool>(c.value));
-	if (signals.getString(c.signal, s) && std::holds_alternative<std::string>(c.value))
-		return compare(s, c.op, std::get<std::string>(c.value));
-	return false;
+	if (const double *rhs = std::get_if<double>(&c.value)) {
+		double n{};
+		return signals.getNumber(c.signal, n) && compareNumber(n, c.op, *rhs);
+	}
+	if (const bool *rhs = std::get_if<bool>(&c.value)) {
+		bool b{};
+		return signals.getBool(c.signal, b) && compareBool(b, c.op, *rhs);
+	}
+	std::string s;
+	return signals.getString(c.signal, s) && compareString(s, c.op, std::get<std::string>(c.value));
 }
 
 static int compareDoubles(double a, double b) {
@@ -139,38 +148,44 @@ static int compareDoubles(double a, double b) {
 }
 
 bool RuleEngine::compare(const Value &lhs, CompareOp op, const Value &rhs) {
-	if (std::holds_alternative<bool>(lhs) && std::holds_alternative<bool>(rhs)) {
-		bool a = std::get<bool>(lhs), b = std::get<bool>(rhs);
-		switch (op) {
-			case CompareOp::Eq: return a == b;
-			case CompareOp::Ne: return a != b;
-			default: return false;
-		}
-	}
-	if (std::holds_alternative<double>(lhs) && std::holds_alternative<double>(rhs)) {
-		double a = std::get<double>(lhs), b = std::get<double>(rhs);
-		int c = compareDoubles(a, b);
-		switch (op) {
-			case CompareOp::Eq: return c == 0;
-			case CompareOp::Ne: return c != 0;
-			case CompareOp::Gt: return c > 0;
-			case CompareOp::Lt: return c < 0;
-			case CompareOp::Ge: return c >= 0;
-			case CompareOp::Le: return c <= 0;
-		}
+	if (std::holds_alternative<bool>(lhs) && std::holds_alternative<bool>(rhs))
+		return compareBool(std::get<bool>(lhs), op, std::get<bool>(rhs));
+	if (std::holds_alternative<double>(lhs) && std::holds_alternative<double>(rhs))
+		return compareNumber(std::get<double>(lhs), op, std::get<double>(rhs));
+	if (std::holds_alternative<std::string>(lhs) && std::holds_alternative<std::string>(rhs))
+		return compareString(std::get<std::string>(lhs), op, std::get<std::string>(rhs));
+	return false;
+}
+
+bool RuleEngine::compareBool(bool lhs, CompareOp op, bool rhs) {
+	switch (op) {
+		case CompareOp::Eq: return lhs == rhs;
+		case CompareOp::Ne: return lhs != rhs;
+		default: return false;
 	}
-	if (std::holds_alternative<std::string>(lhs) && std::holds_alternative<std::string>(rhs)) {
-		const std::string &a = std::get<std::string>(lhs);
-		const std::string &b = std::get<std::string>(rhs);
-		switch (op) {
-			case CompareOp::Eq: return a == b;
-			case CompareOp::Ne: return a != b;
-			default: return false;
-		}
+}
+
+bool RuleEngine::compareNumber(double lhs, CompareOp op, double rhs) {
+	int c = compareDoubles(lhs, rhs);
+	switch (op) {
+		case CompareOp::Eq: return c == 0;
+		case CompareOp::Ne: return c != 0;
+		case CompareOp::Gt: return c > 0;
+		case CompareOp::Lt: return c < 0;
+		case CompareOp::Ge: return c >= 0;
+		case CompareOp::Le: return c <= 0;
 	}
 	return false;
 }
 
+bool RuleEngine::compareString(const std::string &lhs, CompareOp op, const std::string &rhs) {
+	switch (op) {
+		case CompareOp::Eq: return lhs == rhs;
+		case CompareOp::Ne: return lhs != rhs;
+		default: return false;
+	}
+}
+
 std::optional<double> RuleEngine::asNumber(const Value &v) {
 	if (std::holds_alternative<double>(v)) return std::get<double>(v);
 	return std::nullopt;
@@ -195,6 +210,15 @@ void RuleEngine::advanceStep(SteadyClock::time_point now) {
 	}
 }
 
+void RuleEngine::enqueueEvent(std::string eventName) {
+	// Drop events no rule triggers on, so they never occupy a tick.
+	if (rulesByTrigger_.find(eventName) == rulesByTrigger_.end()) {
+		spdlog::debug("drop event without rule: {}", eventName);
+		return;
+	}
+	eventQueue_.push_back(std::move(eventName));
+}
+
 #if defined(DBW_USE_NLOHMANN_JSON)
 
 static CompareOp parseOp(const std::string &key) {
@@ -214,20 +238,24 @@ static Value parseValue(const nlohmann::json &j) {
 }
 
 static bool parseRule(const nlohmann::json &j, Rule &out, std::string &err) {
-	if (!j.contains("name") || !j.contains("trigger") || !j.contains("sequence")) {
+	const auto nameIt = j.find("name");
+	const auto triggerIt = j.find("trigger");
+	const auto sequenceIt = j.find("sequence");
+	if (nameIt == j.end() || triggerIt == j.end() || sequenceIt == j.end()) {
 		err = "rule missing required fields";
 		return false;
 	}
-	out.name = j.at("name").get<std::string>();
-	out.trigger = j.at("trigger").at("on_event").get<std::string>();
+	out.name = nameIt->get<std::string>();
+	out.trigger = triggerIt->at("on_event").get<std::string>();
 
 	out.conditions.clear();
-	if (j.contains("conditions")) {
-		for (const auto &cj : j.at("conditions")) {
+	if (const auto condIt = j.find("conditions"); condIt != j.end()) {
+		out.conditions.reserve(condIt->size());
+		for (const auto &cj : *condIt) {
 			Condition c;
 			c.signal = cj.at("signal").get<std::string>();
 			for (auto it = cj.begin(); it != cj.end(); ++it) {
-				const std::string key = it.key();
+				const std::string &key = it.key();
 				if (key == "signal") continue;
 				c.op = parseOp(key);
 				c.value = parseValue(it.value());
@@ -238,31 +266,31 @@ static bool parseRule(const nlohmann::json &j, Rule &out, std::string &err) {
 	}
 
 	out.sequence.clear();
-	for (const auto &sj : j.at("sequence")) {
-		if (sj.contains("set")) {
-			const auto &setj = sj.at("set");
-			if (setj.size() != 1) { err = "set step must have exactly one key"; return false; }
-			auto it = setj.begin();
+	out.sequence.reserve(sequenceIt->size());
+	for (const auto &sj : *sequenceIt) {
+		const auto end = sj.end();
+		if (const auto setIt = sj.find("set"); setIt != end) {
+			if (setIt->size() != 1) { err = "set step must have exactly one key"; return false; }
+			auto it = setIt->begin();
 			StepSet s{ it.key(), parseValue(it.value()) };
 			out.sequence.emplace_back(std::move(s));
-		} else if (sj.contains("set_state")) {
-			const auto &setj = sj.at("set_state");
-			if (setj.size() != 1) { err = "set_state step must have exactly one key"; return false; }
-			auto it = setj.begin();
+		} else if (const auto stateIt = sj.find("set_state"); stateIt != end) {
+			if (stateIt->size() != 1) { err = "set_state step must have exactly one key"; return false; }
+			auto it = stateIt->begin();
 			StepSetState s{ it.key(), parseValue(it.value()) };
 			out.sequence.emplace_back(std::move(s));
-		} else if (sj.contains("set_all")) {
-			const auto &obj = sj.at("set_all");
+		} else if (const auto allIt = sj.find("set_all"); allIt != end) {
 			StepSetAll sa;
-			for (auto it = obj.begin(); it != obj.end(); ++it) {
+			sa.kvs.reserve(allIt->size());
+			for (auto it = allIt->begin(); it != allIt->end(); ++it) {
 			  sa.kvs.emplace_back(it.key(), parseValue(it.value()));
 			}
 			out.sequence.emplace_back(std::move(sa));
-		} else if (sj.contains("emit_event")) {
-			StepEmitEvent e{ sj.at("emit_event").get<std::string>() };
+		} else if (const auto emitIt = sj.find("emit_event"); emitIt != end) {
+			StepEmitEvent e{ emitIt->get<std::string>() };
 			out.sequence.emplace_back(std::move(e));
-		} else if (sj.contains("wait_ms")) {
-			StepWait w{ Milli(sj.at("wait_ms").get<int>()) };
+		} else if (const auto waitIt = sj.find("wait_ms"); waitIt != end) {
+			StepWait w{ Milli(waitIt->get<int>()) };
 			out.sequence.emplace_back(std::move(w));
 		} else {
 			err = "unknown step type";
@@ -272,24 +300,15 @@ static bool parseRule(const nlohmann::json &j, Rule &out, std::string &err) {
 	return true;
 }
 
-bool RuleEngine::loadRulesFromFile(const std::string &path, std::string &errorMessage) {
-	std::ifstream ifs(path);
-	if (!ifs) { errorMessage = "cannot open file: " + path; return false; }
-	std::stringstream buffer; buffer << ifs.rdbuf();
-	return loadRulesFromJsonString(buffer.str(), errorMessage);
-}
-
-bool RuleEngine::loadRulesFromJsonString(const std::string &jsonText, std::string &errorMessage) {
-	nlohmann::json j;
-	try { j = nlohmann::json::parse(jsonText); }
-	catch (const std::exception &e) { errorMessage = e.what(); return false; }
-
-	if (!j.contains("rules") || !j.at("rules").is_array()) {
+bool RuleEngine::loadRulesFromJson(const nlohmann::json &j, std::string &errorMessage) {
+	const auto rulesIt = j.find("rules");
+	if (rulesIt == j.end() || !rulesIt->is_array()) {
 		errorMessage = "missing 'rules' array";
 		return false;
 	}
 	std::vector<Rule> parsed;
-	for (const auto &rj : j.at("rules")) {
+	parsed.reserve(rulesIt->size());
+	for (const auto &rj : *rulesIt) {
 		Rule r;
 		if (!parseRule(rj, r, errorMessage)) {
 			spdlog::error("rule parse failed: {}", errorMessage);
@@ -302,6 +321,23 @@ bool RuleEngine::loadRulesFromJsonString(const std::string &jsonText, std::strin
 	return true;
 }
 
+bool RuleEngine::loadRulesFromFile(const std::string &path, std::string &errorMessage) {
+	std::ifstream ifs(path);
+	if (!ifs) { errorMessage = "cannot open file: " + path; return false; }
+
+	nlohmann::json j;
+	try { j = nlohmann::json::parse(ifs); }
+	catch (const std::exception &e) { errorMessage = e.what(); return false; }
+	return loadRulesFromJson(j, errorMessage);
+}
+
+bool RuleEngine::loadRulesFromJsonString(const std::string &jsonText, std::string &errorMessage) {
+	nlohmann::json j;
+	try { j = nlohmann::json::parse(jsonText); }
+	catch (const std::exception &e) { errorMessage = e.what(); return false; }
+	return loadRulesFromJson(j, errorMessage);
+}
+
 #endif // DBW_USE_NLOHMANN_JSON
 
 } // namespace dbw
@@ -94,6 +94,9 @@ int main(int argc, char **argv) {
 	CommandBuffer out;
 	engine.onEvent("dbw_toggle_on");
 
+	// Pace ticks against absolute deadlines so work time does not add drift.
+	const Milli period(50);
+	SteadyClock::time_point nextTick = SteadyClock::now();
 	for (int i = 0; i < 20; ++i) {
 		out.clear();
 		engine.tick(sig, out);
@@ -101,7 +104,10 @@ int main(int argc, char **argv) {
 			printCommands(out);
 		}
 		std::cout << "--------------------------\n";
-		std::this_thread::sleep_for(std::chrono::milliseconds(50));
+		nextTick += period;
+		const SteadyClock::time_point now = SteadyClock::now();
+		if (now - nextTick > period) nextTick = now + period; // fell behind: resync, don't burst
+		std::this_thread::sleep_until(nextTick);
 	}
 	return 0;
 }